@@ -10,25 +10,60 @@ Repository: https://github.com/imasmo/flowchart-layout-tool
 License: MIT
 """
 
+import hashlib
+import io
 import json
 import logging
 import os
+import queue
+import shutil
 import subprocess
 import sys
 import tempfile
+import threading
 import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass, field
 from enum import Enum
+from operator import attrgetter
 from pathlib import Path
-from typing import Dict, List, Optional
-from xml.dom import minidom
+from typing import Dict, List, NamedTuple, Optional
+from xml.sax.saxutils import escape
+
+try:
+    import lxml.etree as LET
+except ImportError:  # lxml is optional; fall back to the stdlib parser
+    LET = None
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to the stdlib json module
+    orjson = None
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
 logger = logging.getLogger(__name__)
 
 
+def _json_dumps(obj, sort_keys: bool = False) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+    # Same compact, UTF-8 output as orjson, so cache keys match with or without it.
+    # One dumps call keeps CPython's C encoder; json.dump to a stream would not.
+    return json.dumps(obj, sort_keys=sort_keys, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def _json_loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
 # --- Data Definitions ---
+# Slotted dataclasses (no per-instance __dict__) need Python 3.10+
+_DATACLASS_OPTIONS = {"slots": True} if sys.version_info >= (3, 10) else {}
+
+
 class NodeType(Enum):
     START = "start"
     END = "end"
@@ -36,7 +71,7 @@ class NodeType(Enum):
     DECISION = "decision"
 
 
-@dataclass
+@dataclass(**_DATACLASS_OPTIONS)
 class FlowNode:
     id: str
     node_type: NodeType
@@ -47,7 +82,7 @@ class FlowNode:
     y: float = 0.0
 
 
-@dataclass
+@dataclass(**_DATACLASS_OPTIONS)
 class FlowEdge:
     id: str
     source_id: str
@@ -56,133 +91,298 @@ class FlowEdge:
     source_side: str = "SOUTH"
     target_side: str = "NORTH"
     routing_points: List[Dict] = field(default_factory=list)
+    value: str = ""  # raw label text from the source file
 
 
-@dataclass
+@dataclass(**_DATACLASS_OPTIONS)
 class FlowGraph:
     nodes: Dict[str, FlowNode] = field(default_factory=dict)
     edges: List[FlowEdge] = field(default_factory=list)
 
 
+class _RawCell(NamedTuple):
+    """Attributes of one mxCell, captured while streaming the file."""
+    id: str
+    parent: str
+    style: str
+    value: str
+    source: str
+    target: str
+    edge: bool
+    connectable: str
+    width: Optional[float]  # None when the cell has no mxGeometry or cannot be a node
+    height: Optional[float]
+
+
 # --- Parser ---
 class DrawioParser:
     def __init__(self, xml_path: str):
         self.xml_path = xml_path
         self.graph = FlowGraph()
-        self.cell_map = {}
+        self.parent_index: Dict[str, List[_RawCell]] = {}  # edge label cells by parent id
+        self._edge_pairs = set()  # (source, target) pairs already added
         self.namespace = ""
+        self._geo_tag = None
 
     def parse(self) -> FlowGraph:
+        nodes_raw, edges_raw = [], []
+        edge_ids = set()
+        found_model = False
         try:
-            tree = ET.parse(self.xml_path)
-            root = tree.getroot()
+            # Single streaming pass: each mxCell is reduced to a _RawCell and
+            # cleared, so the DOM is never fully materialized.
+            for el in self._iter_elements():
+                local = el.tag.rpartition("}")[2]
+                if local == "mxGraphModel":
+                    # Only the first diagram page is laid out
+                    found_model = True
+                    break
+                if local != "mxCell":
+                    continue
+                cell = self._read_cell(el)
+                el.clear()
+                if cell is None: continue
+                if "edgeLabel" in cell.style:
+                    self.parent_index.setdefault(cell.parent, []).append(cell)
+                if self._is_edge(cell):
+                    edges_raw.append(cell)
+                    edge_ids.add(cell.id)
+                elif self._is_node(cell):
+                    nodes_raw.append(cell)
         except Exception as e:
             logger.error(f"XML parsing error: {e}")
             raise
 
-        if "}" in root.tag:
-            self.namespace = root.tag.split("}")[0] + "}"
-
-        mxgraph_model = None
-        for elem in root.iter(self.namespace + "mxGraphModel"):
-            mxgraph_model = elem
-            break
-        if mxgraph_model is None:
-            for elem in root.iter("mxGraphModel"):
-                mxgraph_model = elem
-                break
-        if mxgraph_model is None:
+        if not found_model:
             raise ValueError("Invalid draw.io file")
 
-        for cell in mxgraph_model.iter():
-             cid = cell.get("id")
-             if cid: self.cell_map[cid] = cell
-
-        for cell in self.cell_map.values():
-            if self._is_edge(cell):
-                self._parse_edge(cell)
-            elif self._is_node(cell):
+        for cell in edges_raw:
+            self._parse_edge(cell)
+        for cell in nodes_raw:
+            # Children of edges are labels, not nodes
+            if cell.parent not in edge_ids:
                 self._parse_node(cell)
 
         self._extract_edge_labels()
         self._infer_node_types()
         return self.graph
 
-    def _is_edge(self, cell) -> bool:
-        return cell.get("edge") == "1" or (cell.get("source") and cell.get("target"))
-
-    def _is_node(self, cell) -> bool:
-        geo = cell.find(self.namespace + "mxGeometry") or cell.find("mxGeometry")
-        cid = cell.get("id")
-        if cid in ["0", "1"] or geo is None or self._is_edge(cell): return False
-        style = cell.get("style", "").lower()
-        if "edgelabel" in style or cell.get("connectable") == "0": return False
-        parent = cell.get("parent")
-        if parent and parent not in ["0", "1"]:
-             p = self.cell_map.get(parent)
-             if p and self._is_edge(p): return False
+    def _iter_elements(self):
+        if LET is not None:
+            events = LET.iterparse(self.xml_path, events=("end",), tag=("{*}mxCell", "{*}mxGraphModel"))
+        else:
+            events = ET.iterparse(self.xml_path, events=("end",))
+        return (el for _, el in events)
+
+    def _read_cell(self, el) -> Optional[_RawCell]:
+        cid = el.get("id")
+        if not cid: return None
+        if self._geo_tag is None:
+            # The namespace is the same for the whole file, so resolve the tag once
+            if "}" in el.tag:
+                self.namespace = el.tag.split("}")[0] + "}"
+            self._geo_tag = self.namespace + "mxGeometry"
+
+        source = el.get("source", "")
+        target = el.get("target", "")
+        edge = el.get("edge") == "1"
+        w = h = None
+        # Root cells and edges never become nodes; skip the geometry search for them
+        if cid not in ("0", "1") and not (edge or (source and target)):
+            geo = el.find(self._geo_tag)
+            if geo is not None:
+                w = float(geo.get("width", 120))
+                h = float(geo.get("height", 60))
+        return _RawCell(
+            id=cid, parent=el.get("parent", ""), style=el.get("style", ""), value=el.get("value", ""),
+            source=source, target=target, edge=edge,
+            connectable=el.get("connectable", ""), width=w, height=h,
+        )
+
+    def _is_edge(self, cell: _RawCell) -> bool:
+        return cell.edge or bool(cell.source and cell.target)
+
+    def _is_node(self, cell: _RawCell) -> bool:
+        if cell.id in ["0", "1"] or cell.width is None or self._is_edge(cell): return False
+        if "edgelabel" in cell.style.lower() or cell.connectable == "0": return False
         return True
 
-    def _parse_node(self, cell):
-        cid = cell.get("id")
-        style = cell.get("style", "")
-        geo = cell.find(self.namespace + "mxGeometry") or cell.find("mxGeometry")
-        w = float(geo.get("width", 120))
-        h = float(geo.get("height", 60))
-
+    def _parse_node(self, cell: _RawCell):
         ntype = NodeType.PROCESS
-        s_low = style.lower()
+        s_low = cell.style.lower()
         if "rhombus" in s_low or "diamond" in s_low: ntype = NodeType.DECISION
         elif "ellipse" in s_low: ntype = NodeType.START
 
-        self.graph.nodes[cid] = FlowNode(id=cid, node_type=ntype, label=cell.get("value", ""), width=w, height=h)
+        self.graph.nodes[cell.id] = FlowNode(id=cell.id, node_type=ntype, label=cell.value, width=cell.width, height=cell.height)
 
-    def _parse_edge(self, cell):
-        src = cell.get("source")
-        tgt = cell.get("target")
+    def _parse_edge(self, cell: _RawCell):
+        src = cell.source
+        tgt = cell.target
         if src and tgt:
-            if not any(e.source_id == src and e.target_id == tgt for e in self.graph.edges):
-                self.graph.edges.append(FlowEdge(id=cell.get("id"), source_id=src, target_id=tgt))
+            if (src, tgt) not in self._edge_pairs:
+                self._edge_pairs.add((src, tgt))
+                self.graph.edges.append(FlowEdge(id=cell.id, source_id=src, target_id=tgt, value=cell.value))
 
     def _extract_edge_labels(self):
         for edge in self.graph.edges:
-            cell = self.cell_map.get(edge.id)
-            if cell and cell.get("value"):
-                 val = cell.get("value", "").lower()
+            if edge.value:
+                 val = edge.value.lower()
                  if val in ["y", "yes"]: edge.label = "yes"
                  elif val in ["n", "no"]: edge.label = "no"
                  continue
-            for child in self.cell_map.values():
-                if child.get("parent") == edge.id and "edgeLabel" in child.get("style", ""):
-                    val = child.get("value", "").lower()
-                    if val in ["y", "yes"]: edge.label = "yes"
-                    elif val in ["n", "no"]: edge.label = "no"
-                    break
+            for child in self.parent_index.get(edge.id, ()):
+                val = child.value.lower()
+                if val in ["y", "yes"]: edge.label = "yes"
+                elif val in ["n", "no"]: edge.label = "no"
+                break
 
     def _infer_node_types(self):
-        ins = {n:0 for n in self.graph.nodes}
-        outs = {n:0 for n in self.graph.nodes}
-        for e in self.graph.edges:
-            if e.source_id in outs: outs[e.source_id]+=1
-            if e.target_id in ins: ins[e.target_id]+=1
-        for nid, node in self.graph.nodes.items():
-            if ins[nid]==0 and outs[nid]>0: node.node_type = NodeType.START
-            if outs[nid]==0 and ins[nid]>0: node.node_type = NodeType.END
+        # Every node type inferred here needs at least one edge; without
+        # edges the shape-based types from _parse_node are final
+        if not self.graph.edges: return
+
+        # Only whether a node has in/out edges matters, not how many:
+        # pure sources start the flow, pure sinks end it.
+        sources = set(map(attrgetter("source_id"), self.graph.edges))
+        targets = set(map(attrgetter("target_id"), self.graph.edges))
+        nodes = self.graph.nodes
+        for nid in sources - targets:
+            if nid in nodes: nodes[nid].node_type = NodeType.START
+        for nid in targets - sources:
+            if nid in nodes: nodes[nid].node_type = NodeType.END
 
 
 # --- Core Engine ---
+# Node.js side of _ElkWorker: one ELK graph per stdin line, one result (or error) per stdout line.
+# Replies keep only the fields _apply_layout reads, instead of echoing the whole input graph back.
+ELK_WORKER_JS = """
+const ELK = require('elkjs');
+const elk = new ELK();
+const slim = r => ({
+    children: (r.children || []).map(c => ({ id: c.id, x: c.x, y: c.y })),
+    edges: (r.edges || []).map(e => ({
+        id: e.id, sources: e.sources, targets: e.targets,
+        sections: (e.sections || []).map(s => ({ startPoint: s.startPoint, bendPoints: s.bendPoints, endPoint: s.endPoint }))
+    }))
+});
+require('readline').createInterface({ input: process.stdin }).on('line', line => {
+    Promise.resolve()
+        .then(() => elk.layout(JSON.parse(line)))
+        .then(r => process.stdout.write(JSON.stringify(slim(r)) + '\\n'))
+        .catch(e => process.stdout.write(JSON.stringify({ error: String(e) }) + '\\n'));
+});
+"""
+
+
+class _ElkWorker:
+    """Long-lived Node.js process running elkjs, so Node startup is paid once per engine."""
+
+    def __init__(self, timeout: float = 30):
+        self.timeout = timeout
+        self.proc = None
+        self._lines = None
+
+    def start(self):
+        # Path resolution
+        real_project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        if not os.path.exists(os.path.join(real_project_root, "node_modules")):
+            real_project_root = os.getcwd()
+
+        env = os.environ.copy()
+        env["NODE_PATH"] = os.path.join(real_project_root, "node_modules")
+
+        self.proc = subprocess.Popen(
+            ["node", "-e", ELK_WORKER_JS],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            env=env
+        )
+        # Read replies on a thread so a hung worker can be timed out
+        self._lines = queue.Queue()
+        threading.Thread(target=self._read_replies, args=(self.proc.stdout, self._lines), daemon=True).start()
+
+    @staticmethod
+    def _read_replies(stdout, lines: queue.Queue):
+        for line in stdout:
+            lines.put(line)
+        lines.put(None)  # EOF: the worker exited
+
+    def layout(self, elk_graph: dict) -> dict:
+        if self.proc is None or self.proc.poll() is not None:
+            self.start()
+
+        self.proc.stdin.write(_json_dumps(elk_graph))
+        self.proc.stdin.write(b"\n")
+        self.proc.stdin.flush()
+
+        try:
+            line = self._lines.get(timeout=self.timeout)
+        except queue.Empty:
+            self.close()
+            raise RuntimeError(f"ELK did not respond within {self.timeout}s")
+        if line is None:
+            self.proc.wait()
+            raise RuntimeError(f"ELK worker exited with code {self.proc.returncode}")
+
+        result = _json_loads(line)
+        if "error" in result:
+            raise RuntimeError(result["error"])
+        return result
+
+    def close(self):
+        if self.proc is None: return
+        try:
+            self.proc.stdin.close()
+            self.proc.wait(timeout=5)
+        except Exception:
+            self.proc.kill()
+        self.proc = None
+
+
+DEFAULT_CACHE_DIR = Path.home() / ".cache" / "flowchart-layout-tool"
+# Mixed into every cache key. Bump it whenever the ELK_WORKER_JS protocol or
+# reply shape, or the elkjs version the tool expects, changes, so that
+# layouts cached by an older version are not served again.
+CACHE_FORMAT_VERSION = 2
+
+
+# ELK options that do not depend on the engine's spacing
+_STATIC_LAYOUT_OPTIONS = {
+    "elk.algorithm": "layered",
+    "elk.direction": "DOWN",
+    "elk.edgeRouting": "ORTHOGONAL",
+
+    # Revert to V1.1's core algorithm for compact aesthetics
+    "elk.layered.nodePlacement.strategy": "BRANDES_KOEPF",
+
+    # Auxiliary alignment strategy
+    "elk.layered.crossingMinimization.strategy": "LAYER_SWEEP",
+
+    # Spacing fine-tuning (node spacings come from the engine)
+    "elk.spacing.edgeNode": "35.0",
+    "elk.spacing.edgeEdge": "25.0",
+
+    "elk.portConstraints": "FIXED_SIDE",
+    "elk.portAlignment.default": "CENTER"
+}
+
+
 class ELKLayoutEngine:
     NODE_SPACING = 50.0
     LAYER_SPACING = 36.0
+    PORT_SIDES = (("N", "NORTH"), ("S", "SOUTH"), ("E", "EAST"), ("W", "WEST"))
 
-    def __init__(self, node_spacing: float = None, layer_spacing: float = None):
+    def __init__(self, node_spacing: float = None, layer_spacing: float = None,
+                 cache_dir: Optional[str] = None, use_cache: bool = True):
         if node_spacing: self.NODE_SPACING = node_spacing
         if layer_spacing: self.LAYER_SPACING = layer_spacing
+        self.cache_dir = Path(cache_dir) if cache_dir else DEFAULT_CACHE_DIR
+        self.use_cache = use_cache
+        self._worker = None
 
     def layout(self, graph: FlowGraph) -> FlowGraph:
         logger.info("Starting layout computation ...")
         elk_graph = self._build_elk_graph(graph)
-        result = self._call_elk_robust(elk_graph)
+        result = self._call_elk_cached(elk_graph)
         self._apply_layout(graph, result)
         logger.info("Layout computation completed")
         return graph
@@ -190,22 +390,10 @@ class ELKLayoutEngine:
     def _build_elk_graph(self, graph: FlowGraph) -> dict:
         elk_nodes = []
         elk_edges = []
+        used_ports = set()
+        self_loop_nodes = set()
 
-        # Nodes and ports
-        for nid, node in graph.nodes.items():
-            ports = [
-                {"id": f"{nid}_N", "properties": {"port.side": "NORTH"}},
-                {"id": f"{nid}_S", "properties": {"port.side": "SOUTH"}},
-                {"id": f"{nid}_E", "properties": {"port.side": "EAST"}},
-                {"id": f"{nid}_W", "properties": {"port.side": "WEST"}},
-            ]
-            elk_nodes.append({
-                "id": nid, "width": node.width, "height": node.height,
-                "ports": ports,
-                "properties": {"portConstraints": "FIXED_SIDE"}
-            })
-
-        # Edges
+        # Edges first, so nodes only declare the ports that are actually connected
         for i, edge in enumerate(graph.edges):
             src_node = graph.nodes.get(edge.source_id)
             if not src_node: continue
@@ -226,6 +414,10 @@ class ELKLayoutEngine:
                     src_port = f"{edge.source_id}_S"
                     edge_priority = 10 # Yes branch: high priority, enforce straight line
 
+            used_ports.add(src_port)
+            used_ports.add(tgt_port)
+            if edge.source_id == edge.target_id:
+                self_loop_nodes.add(edge.source_id)
             elk_edges.append({
                 "id": edge.id or f"e{i}",
                 "sources": [src_port],
@@ -236,94 +428,94 @@ class ELKLayoutEngine:
                 }
             })
 
+        # Nodes and ports
+        for nid, node in graph.nodes.items():
+            ports = []
+            for suffix, side in self.PORT_SIDES:
+                port_id = f"{nid}_{suffix}"
+                # ELK routes self-loops around the unused ports too, so those
+                # nodes keep the full N/S/E/W set to preserve their layout
+                if port_id in used_ports or nid in self_loop_nodes:
+                    ports.append({"id": port_id, "properties": {"port.side": side}})
+            elk_nodes.append({
+                "id": nid, "width": node.width, "height": node.height,
+                "ports": ports,
+                "properties": {"portConstraints": "FIXED_SIDE"}
+            })
+
         return {
             "id": "root",
             "layoutOptions": {
-                "elk.algorithm": "layered",
-                "elk.direction": "DOWN",
-                "elk.edgeRouting": "ORTHOGONAL",
-
-                # Revert to V1.1's core algorithm for compact aesthetics
-                "elk.layered.nodePlacement.strategy": "BRANDES_KOEPF",
-
-                # Auxiliary alignment strategy
-                "elk.layered.crossingMinimization.strategy": "LAYER_SWEEP",
-
-                # Spacing fine-tuning
+                **_STATIC_LAYOUT_OPTIONS,
                 "elk.layered.spacing.nodeNodeBetweenLayers": str(self.LAYER_SPACING),
                 "elk.spacing.nodeNode": str(self.NODE_SPACING),
-                "elk.spacing.edgeNode": "35.0",
-                "elk.spacing.edgeEdge": "25.0",
-
-                "elk.portConstraints": "FIXED_SIDE",
-                "elk.portAlignment.default": "CENTER"
             },
             "children": elk_nodes,
             "edges": elk_edges,
         }
 
-    def _call_elk_robust(self, elk_graph: dict) -> dict:
+    def _call_elk_cached(self, elk_graph: dict) -> dict:
+        """Return the ELK result for elk_graph, reusing a cached result on disk if present."""
+        if not self.use_cache:
+            return self._call_elk_robust(elk_graph)
+
+        hasher = hashlib.blake2b(f"v{CACHE_FORMAT_VERSION}\n".encode("utf-8"), digest_size=16)
+        hasher.update(_json_dumps(elk_graph, sort_keys=True))
+        key = hasher.hexdigest()
+        cache_path = self.cache_dir / f"{key}.json"
+        try:
+            result = _json_loads(cache_path.read_bytes())
+            logger.info("Using cached layout")
+            return result
+        except (OSError, ValueError):
+            pass
+
+        result = self._call_elk_robust(elk_graph)
+
+        # Write to a temp file and rename, so a concurrent run never reads a partial entry
+        tmp_path = None
         try:
-            # 1. Check elkjs availability
-            project_root = Path(__file__).parent.parent
-            elkjs_path = project_root / "node_modules" / "elkjs"
-
-            if not elkjs_path.exists() and not (Path(os.getcwd()) / "node_modules" / "elkjs").exists():
-                 subprocess.run(["node", "-e", "require('elkjs')"], check=True, capture_output=True)
-
-            # 2. JS script
-            js_code = f"""
-            const ELK = require('elkjs');
-            const elk = new ELK();
-            const graph = {json.dumps(elk_graph)};
-            elk.layout(graph)
-                .then(r => console.log(JSON.stringify(r)))
-                .catch(e => {{ console.error(e); process.exit(1); }});
-            """
-
-            with tempfile.NamedTemporaryFile(mode="w", suffix=".js", delete=False, encoding="utf-8") as f:
-                f.write(js_code)
-                js_path = f.name
-
-            # 3. Path resolution
-            real_project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-            if not os.path.exists(os.path.join(real_project_root, "node_modules")):
-                real_project_root = os.getcwd()
-
-            env = os.environ.copy()
-            env["NODE_PATH"] = os.path.join(real_project_root, "node_modules")
-
-            # 4. Execute
-            result = subprocess.run(
-                ["node", js_path],
-                capture_output=True, text=True, timeout=30,
-                env=env
-            )
-
-            try: os.unlink(js_path)
-            except: pass
-
-            if result.returncode != 0:
-                logger.error(f"ELK failed: {result.stderr}")
-                raise RuntimeError(result.stderr)
-
-            return json.loads(result.stdout)
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=self.cache_dir)
+            with os.fdopen(fd, "wb") as f:
+                f.write(_json_dumps(result))
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            logger.warning(f"Could not write layout cache: {e}")
+            if tmp_path is not None:
+                try: os.unlink(tmp_path)
+                except OSError: pass
+        return result
 
+    def _call_elk_robust(self, elk_graph: dict) -> dict:
+        try:
+            if self._worker is None:
+                self._worker = _ElkWorker()
+            return self._worker.layout(elk_graph)
         except Exception as e:
             logger.error(f"ELK invocation error: {e}")
             raise
 
+    def close(self):
+        """Stop the Node.js worker, if one was started."""
+        if self._worker is not None:
+            self._worker.close()
+            self._worker = None
+
     def _apply_layout(self, graph: FlowGraph, elk_result: dict):
         scale = 1.0
+        nodes = graph.nodes
+        edges_by_id = {e.id: e for e in graph.edges}
+
         for child in elk_result.get("children", []):
-            nid = child["id"]
-            if nid in graph.nodes:
-                graph.nodes[nid].x = child["x"] * scale
-                graph.nodes[nid].y = child["y"] * scale
+            node = nodes.get(child["id"])
+            if node:
+                node.x = child["x"] * scale
+                node.y = child["y"] * scale
 
         for edge_res in elk_result.get("edges", []):
             eid = edge_res["id"]
-            edge = next((e for e in graph.edges if e.id == eid), None)
+            edge = edges_by_id.get(eid)
             if not edge: continue
 
             points = []
@@ -340,103 +532,196 @@ class ELKLayoutEngine:
 
 
 # --- Generator ---
+_XML_ATTR_ENTITIES = {'"': "&quot;", "\n": "&#10;", "\r": "&#13;", "\t": "&#9;"}
+
+
+def _xml_attr(value: str) -> str:
+    """Escape a string for use inside a double-quoted XML attribute."""
+    return escape(value, _XML_ATTR_ENTITIES)
+
+
+# Relative (x, y) connection point on a node for each port side
+_PORT_ANCHORS = {"N": ("0.5", "0"), "S": ("0.5", "1"), "E": ("1", "0.5"), "W": ("0", "0.5")}
+
+
 class DrawioGenerator:
+    BASE_STYLE = "html=1;whiteSpace=wrap;"
+    NODE_STYLES = {
+        NodeType.START: BASE_STYLE + "ellipse;fillColor=#d5e8d4;strokeColor=#82b366;",
+        NodeType.END: BASE_STYLE + "ellipse;fillColor=#f8cecc;strokeColor=#b85450;",
+        NodeType.PROCESS: BASE_STYLE + "rounded=0;fillColor=#dae8fc;strokeColor=#6c8ebf;",
+        NodeType.DECISION: BASE_STYLE + "rhombus;fillColor=#fff2cc;strokeColor=#d6b656;"
+    }
+    # One edge style per (source side, target side) pair; only 16 exist
+    EDGE_STYLES = {
+        (s, t): ("edgeStyle=orthogonalEdgeStyle;rounded=0;orthogonalLoop=1;jettySize=auto;html=1;"
+                 f"exitX={_PORT_ANCHORS[s][0]};exitY={_PORT_ANCHORS[s][1]};"
+                 f"entryX={_PORT_ANCHORS[t][0]};entryY={_PORT_ANCHORS[t][1]};entryPerimeter=0;")
+        for s in _PORT_ANCHORS for t in _PORT_ANCHORS
+    }
+
+    HEADER = (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<mxfile host="elk-v4" version="4.0">\n'
+        '  <diagram name="Flowchart">\n'
+        '    <mxGraphModel dx="1200" dy="1200" grid="1" gridSize="10">\n'
+        '      <root>\n'
+        '        <mxCell id="0"/>\n'
+        '        <mxCell id="1" parent="0"/>\n'
+    )
+    FOOTER = (
+        '      </root>\n'
+        '    </mxGraphModel>\n'
+        '  </diagram>\n'
+        '</mxfile>\n'
+    )
+    NODE_TEMPLATE = (
+        '        <mxCell id="{id}" value="{value}" style="{style}" vertex="1" parent="1">\n'
+        '          <mxGeometry x="{x}" y="{y}" width="{width}" height="{height}" as="geometry"/>\n'
+        '        </mxCell>\n'
+    )
+    EDGE_TEMPLATE = (
+        '        <mxCell id="{id}" value="{value}" style="{style}" edge="1" parent="1" '
+        'source="{source}" target="{target}">\n'
+    )
+    POINT_TEMPLATE = '              <mxPoint x="{x}" y="{y}"/>\n'
+
     def __init__(self, graph: FlowGraph):
         self.graph = graph
 
     def generate(self, output_path: str):
-        mxfile = ET.Element("mxfile", {"host": "elk-v4", "version": "4.0"})
-        diagram = ET.SubElement(mxfile, "diagram", {"name": "Flowchart"})
-        model = ET.SubElement(diagram, "mxGraphModel", {"dx":"1200", "dy":"1200", "grid":"1", "gridSize":"10"})
-        root = ET.SubElement(model, "root")
-        ET.SubElement(root, "mxCell", {"id": "0"})
-        ET.SubElement(root, "mxCell", {"id": "1", "parent": "0"})
+        # The output layout is fixed, so write the XML text directly instead of
+        # building an element tree only to serialize and pretty-print it
+        buf = io.StringIO()
+        buf.write(self.HEADER)
 
         for node in self.graph.nodes.values():
-            self._write_node(root, node)
+            self._write_node(buf, node)
 
         for edge in self.graph.edges:
-            self._write_edge(root, edge)
+            self._write_edge(buf, edge)
 
-        xml_str = minidom.parseString(ET.tostring(mxfile)).toprettyxml(indent="  ")
-        xml_str = "\n".join([line for line in xml_str.split("\n") if line.strip()])
+        buf.write(self.FOOTER)
 
         with open(output_path, "w", encoding="utf-8") as f:
-            f.write(xml_str)
-
-    def _write_node(self, root, node: FlowNode):
-        base_style = "html=1;whiteSpace=wrap;"
-        styles = {
-            NodeType.START: base_style + "ellipse;fillColor=#d5e8d4;strokeColor=#82b366;",
-            NodeType.END: base_style + "ellipse;fillColor=#f8cecc;strokeColor=#b85450;",
-            NodeType.PROCESS: base_style + "rounded=0;fillColor=#dae8fc;strokeColor=#6c8ebf;",
-            NodeType.DECISION: base_style + "rhombus;fillColor=#fff2cc;strokeColor=#d6b656;"
-        }
-        cell = ET.SubElement(root, "mxCell", {
-            "id": node.id, "value": node.label,
-            "style": styles.get(node.node_type, styles[NodeType.PROCESS]),
-            "vertex": "1", "parent": "1"
-        })
-        ET.SubElement(cell, "mxGeometry", {
-            "x": str(node.x), "y": str(node.y),
-            "width": str(node.width), "height": str(node.height), "as": "geometry"
-        })
-
-    def _write_edge(self, root, edge: FlowEdge):
-        pmap = { "N": ("0.5", "0"), "S": ("0.5", "1"), "E": ("1", "0.5"), "W": ("0", "0.5") }
-        ex, ey = pmap.get(edge.source_side, ("0.5", "1"))
-        ix, iy = pmap.get(edge.target_side, ("0.5", "0"))
-
-        style = (f"edgeStyle=orthogonalEdgeStyle;rounded=0;orthogonalLoop=1;jettySize=auto;html=1;"
-                 f"exitX={ex};exitY={ey};entryX={ix};entryY={iy};entryPerimeter=0;")
+            f.write(buf.getvalue())
+
+    def _write_node(self, buf: io.StringIO, node: FlowNode):
+        buf.write(self.NODE_TEMPLATE.format(
+            id=_xml_attr(node.id), value=_xml_attr(node.label),
+            style=self.NODE_STYLES.get(node.node_type, self.NODE_STYLES[NodeType.PROCESS]),
+            x=node.x, y=node.y, width=node.width, height=node.height
+        ))
+
+    def _write_edge(self, buf: io.StringIO, edge: FlowEdge):
+        # Sides that were never laid out fall back to leaving south and entering north
+        src_side = edge.source_side if edge.source_side in _PORT_ANCHORS else "S"
+        tgt_side = edge.target_side if edge.target_side in _PORT_ANCHORS else "N"
+        style = self.EDGE_STYLES[(src_side, tgt_side)]
 
         lbl = ""
         if edge.label == "yes": lbl = "Y"
         elif edge.label == "no": lbl = "N"
 
-        cell = ET.SubElement(root, "mxCell", {
-            "id": edge.id, "value": lbl, "style": style,
-            "edge": "1", "parent": "1", "source": edge.source_id, "target": edge.target_id
-        })
-        geo = ET.SubElement(cell, "mxGeometry", {"relative": "1", "as": "geometry"})
+        buf.write(self.EDGE_TEMPLATE.format(
+            id=_xml_attr(edge.id), value=lbl, style=style,
+            source=_xml_attr(edge.source_id), target=_xml_attr(edge.target_id)
+        ))
 
         if edge.routing_points:
-            pts = ET.SubElement(geo, "Array", {"as": "points"})
+            buf.write('          <mxGeometry relative="1" as="geometry">\n'
+                      '            <Array as="points">\n')
             for p in edge.routing_points:
-                ET.SubElement(pts, "mxPoint", {"x": str(p["x"]), "y": str(p["y"])})
+                buf.write(self.POINT_TEMPLATE.format(x=p["x"], y=p["y"]))
+            buf.write('            </Array>\n'
+                      '          </mxGeometry>\n')
+        else:
+            buf.write('          <mxGeometry relative="1" as="geometry"/>\n')
+        buf.write('        </mxCell>\n')
+
+
+def process_file(input_path: str, output_path: str, layout: ELKLayoutEngine):
+    graph = DrawioParser(input_path).parse()
+    graph = layout.layout(graph)
+    DrawioGenerator(graph).generate(output_path)
+    logger.info(f"Done: {output_path}")
+
+
+def default_output_path(input_path: str) -> str:
+    return str(Path(input_path).parent / f"{Path(input_path).stem}_textbook.drawio")
+
+
+# --- Batch mode ---
+# Each pool process keeps its own engine, and with it one long-lived ELK worker
+_batch_layout: Optional[ELKLayoutEngine] = None
+
+
+def _init_batch_process(use_cache: bool):
+    global _batch_layout
+    _batch_layout = ELKLayoutEngine(use_cache=use_cache)
+
+
+def _process_batch_file(paths) -> bool:
+    input_path, output_path = paths
+    try:
+        process_file(input_path, output_path, _batch_layout)
+        return True
+    except Exception as e:
+        logger.error(f"Failed: {input_path}: {e}")
+        return False
+
+
+def process_directory(input_dir: str, output_dir: Optional[str] = None, jobs: Optional[int] = None,
+                      use_cache: bool = True):
+    """Lay out every .drawio file in input_dir, spreading files over a process pool."""
+    if output_dir:
+        Path(output_dir).mkdir(parents=True, exist_ok=True)
+        tasks = [(str(p), str(Path(output_dir) / p.name)) for p in sorted(Path(input_dir).glob("*.drawio"))]
+    else:
+        # Outputs land next to the inputs; skip results of earlier runs
+        tasks = [(str(p), default_output_path(str(p))) for p in sorted(Path(input_dir).glob("*.drawio"))
+                 if not p.stem.endswith("_textbook")]
+    if not tasks:
+        logger.warning(f"No .drawio files found in {input_dir}")
+        return
+
+    workers = min(jobs or os.cpu_count() or 1, len(tasks))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_batch_process, initargs=(use_cache,)) as executor:
+        done = sum(executor.map(_process_batch_file, tasks))
+    logger.info(f"Processed {done}/{len(tasks)} files")
 
 
 def main():
     import argparse
     parser = argparse.ArgumentParser(description="UML Flowchart Layout Tool")
-    parser.add_argument("input", help="Input drawio xml")
-    parser.add_argument("output", nargs="?", help="Output file path")
+    parser.add_argument("input", help="Input drawio xml, or a directory of .drawio files")
+    parser.add_argument("output", nargs="?", help="Output file path (output directory for directory input)")
+    parser.add_argument("--no-cache", action="store_true", help="Always run ELK, ignoring cached layouts")
+    parser.add_argument("-j", "--jobs", type=int, help="Parallel processes for directory input (default: CPU count)")
     args = parser.parse_args()
+    if args.jobs is not None and args.jobs < 1:
+        parser.error("--jobs must be at least 1")
 
-    try: subprocess.run(["node", "-v"], check=True, stdout=subprocess.DEVNULL)
-    except:
+    # Look node up on PATH rather than spawning `node -v` just to probe for it
+    if shutil.which("node") is None:
         logger.error("Node.js is not installed")
         sys.exit(1)
 
-    out_file = args.output
-    if not out_file:
-        out_file = str(Path(args.input).parent / f"{Path(args.input).stem}_textbook.drawio")
-
-    try:
-        parser = DrawioParser(args.input)
-        graph = parser.parse()
-
-        layout = ELKLayoutEngine()
-        graph = layout.layout(graph)
+    if Path(args.input).is_dir():
+        process_directory(args.input, args.output, jobs=args.jobs, use_cache=not args.no_cache)
+        return
 
-        gen = DrawioGenerator(graph)
-        gen.generate(out_file)
+    out_file = args.output or default_output_path(args.input)
 
-        logger.info(f"Done: {out_file}")
+    layout = ELKLayoutEngine(use_cache=not args.no_cache)
+    try:
+        process_file(args.input, out_file, layout)
     except Exception as e:
         logger.error(f"Failed: {e}")
         import traceback
         traceback.print_exc()
+    finally:
+        layout.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file